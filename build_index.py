@@ -0,0 +1,88 @@
+import argparse
+import os
+from typing import Dict, List
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+INDEX_FILE_NAME = "paper_index.parquet"
+
+def index_path(output_dir: str, year: str) -> str:
+    return os.path.join(output_dir, str(year), INDEX_FILE_NAME)
+
+def source_signature(year_dir: str) -> Dict[str, List[int]]:
+    # Size and mtime of every raw file, stored with the index so it can tell
+    # when the files it points into have changed
+    signature = {}
+    for entry in sorted(os.scandir(year_dir), key=lambda entry: entry.name):
+        if entry.name.endswith('.jsonl'):
+            stat = entry.stat()
+            signature[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+def build_index(year_dir: str, index_file: str):
+    # One pass over a year's raw files, recording where every paper's line
+    # starts so later passes can seek straight to the papers they need
+    paper_ids = []
+    files = []
+    offsets = []
+    disciplines = []
+
+    signature = source_signature(year_dir)
+    for file_name in signature:
+        with open(os.path.join(year_dir, file_name), 'rb') as file:
+            offset = 0
+            for line in file:
+                paper = orjson.loads(line)
+                paper_ids.append(paper['paper_id'])
+                files.append(file_name)
+                offsets.append(offset)
+                disciplines.append(paper['discipline'])
+                offset += len(line)
+
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    table = pa.table({
+        'paper_id': pa.array(paper_ids, type=pa.string()),
+        'file': pa.array(files, type=pa.string()),
+        'offset': pa.array(offsets, type=pa.int64()),
+        'discipline': pa.array(disciplines, type=pa.string()),
+    }).replace_schema_metadata({'sources': orjson.dumps(signature)})
+    # Write under a temporary name so an interrupted build never leaves a
+    # truncated index behind
+    pq.write_table(table, index_file + '.tmp')
+    os.replace(index_file + '.tmp', index_file)
+
+def ensure_index(year_dir: str, index_file: str):
+    if os.path.exists(index_file):
+        metadata = pq.read_schema(index_file).metadata or {}
+        if b'sources' in metadata and orjson.loads(metadata[b'sources']) == source_signature(year_dir):
+            return
+        print(f"Rebuilding stale paper index {index_file}")
+    else:
+        print(f"Building paper index {index_file}")
+    build_index(year_dir, index_file)
+
+def field_offsets(index_file: str, field: str) -> Dict[str, List[int]]:
+    # Offsets of every paper in the field, grouped by file and sorted so reads
+    # only ever seek forward
+    table = pq.read_table(index_file, columns=['file', 'offset'], filters=[('discipline', '==', field)])
+    offsets = {}
+    for file_name, offset in zip(table['file'].to_pylist(), table['offset'].to_pylist()):
+        offsets.setdefault(file_name, []).append(offset)
+    for file_offsets in offsets.values():
+        file_offsets.sort()
+    return offsets
+
+def main():
+    parser = argparse.ArgumentParser(description="Index raw jsonl papers by file offset and discipline")
+    parser.add_argument("--source_dir", type=str, default="../..", help="Directory containing one folder of raw jsonl files per year")
+    parser.add_argument("--output_dir", type=str, default="../../cleaned", help="Directory the per-year indexes are written to")
+    parser.add_argument("years", nargs="+", help="Years to index")
+    args = parser.parse_args()
+
+    for year in args.years:
+        build_index(os.path.join(args.source_dir, year), index_path(args.output_dir, year))
+        print(f"Indexed year {year}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import torch
+import xxhash
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+
+# Sequence lengths are rounded up to a multiple of this when shapes must be static
+SEQ_BUCKET = 64
+
+# Texts per task sent to a tokenizer worker
+TOKENIZE_CHUNK = 256
+
+_TOKENIZER = None
+
+def _init_tokenizer_worker(model_name):
+    global _TOKENIZER
+    # Parallelism comes from the worker processes; a Rust thread pool in each
+    # of them would oversubscribe the cores
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _TOKENIZER = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+
+def tokenize_to_arrays(tokenizer, texts, max_length):
+    encoded = tokenizer(texts, truncation=True, max_length=max_length, return_attention_mask=False, return_token_type_ids=False)
+    return [np.asarray(ids, dtype=np.int32) for ids in encoded["input_ids"]]
+
+def _tokenize_in_worker(texts, max_length):
+    return tokenize_to_arrays(_TOKENIZER, texts, max_length)
+
+def mean_pool(hidden, attention_mask):
+    mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+    summed = (hidden * mask).sum(dim=1)
+    counts = mask.sum(dim=1).clamp(min=1e-9)
+    return summed / counts
+
+
+class Embedder:
+    def __init__(self, model_name, device="cuda", batch_size=64, max_length=512, onnx_path=None, cache_size=20000, compile_model=False, cuda_graphs=False, tokenizer_workers=0):
+        self.device = device
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+        # Tokenization runs in separate processes, driven from prepare() on its
+        # own thread, so it never competes with the thread launching GPU work.
+        # The pool is forked before any other thread starts; spawn would re-run
+        # the calling script in every worker.
+        self._tokenizer_pool = None
+        if tokenizer_workers > 0:
+            self._tokenizer_pool = ProcessPoolExecutor(
+                max_workers=tokenizer_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_tokenizer_worker,
+                initargs=(model_name,),
+            )
+            # Workers are forked on the first submit, so make that happen now
+            self._tokenizer_pool.submit(int).result()
+        self.tokenizer_workers = tokenizer_workers
+
+        # Every forward, warmup included, runs on this one thread. Inductor
+        # records its CUDA graphs per thread, so forwards from any other thread
+        # would re-record them mid-run and strand the old memory pools.
+        self.gpu_thread = ThreadPoolExecutor(max_workers=1)
+
+        # LRU of text hash -> embedding, so boilerplate that repeats across papers
+        # (acknowledgements, stub headings, captions) skips the model entirely
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # Half precision on GPU: bf16 where the hardware supports it, fp16 otherwise
+        if device == "cuda":
+            self.dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            self.dtype = torch.float32
+
+        # Host-to-device copies run on their own stream so they overlap compute
+        self.copy_stream = torch.cuda.Stream() if device == "cuda" else None
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.hidden_size = AutoConfig.from_pretrained(model_name).hidden_size
+
+        if compile_model and cuda_graphs:
+            raise ValueError("torch.compile in max-autotune mode already uses CUDA graphs")
+        if cuda_graphs and device != "cuda":
+            raise ValueError("CUDA graphs require a CUDA device")
+
+        if onnx_path is not None:
+            self._init_onnx(onnx_path)
+            self._forward = self._forward_onnx
+        else:
+            # SDPA checks the mask on the host to decide whether it can be
+            # skipped, which a captured graph would freeze; eager attention
+            # always applies the mask as data
+            attn_implementation = "eager" if cuda_graphs else None
+            self.model = AutoModel.from_pretrained(model_name, torch_dtype=self.dtype, attn_implementation=attn_implementation).to(device).eval()
+            self._forward = self._forward_torch
+
+        # Compiled kernels and captured graphs are specialised per shape, so every
+        # batch is padded to batch_size rows and a multiple of SEQ_BUCKET tokens
+        self.static_shapes = (compile_model or cuda_graphs) and onnx_path is None
+        if self.static_shapes:
+            if compile_model:
+                self.model = torch.compile(self.model, mode="max-autotune", dynamic=False)
+            else:
+                # One graph per (batch, length) bucket, all sharing a memory pool
+                self._graphs = {}
+                self._graph_pool = torch.cuda.graph_pool_handle()
+                self._forward = self._forward_graph
+            self.gpu_thread.submit(self._warmup).result()
+
+    def _init_onnx(self, onnx_path):
+        import onnxruntime as ort
+
+        if self.device != "cuda":
+            raise ValueError("ONNX inference requires a CUDA device")
+        self.device_id = torch.cuda.current_device()
+        self.session = ort.InferenceSession(
+            onnx_path,
+            providers=[("CUDAExecutionProvider", {"device_id": self.device_id})],
+        )
+        # Output buffer sized for a full batch, bound in place so results never
+        # round-trip through host memory inside onnxruntime
+        self._onnx_output = torch.empty((self.batch_size, self.hidden_size), dtype=torch.float32, device=self.device)
+
+    def _bucket_lengths(self):
+        longest = -(-self.max_length // SEQ_BUCKET) * SEQ_BUCKET
+        return range(SEQ_BUCKET, longest + 1, SEQ_BUCKET)
+
+    @torch.inference_mode()
+    def _warmup(self):
+        # Compile or capture every bucket up front so the first real batch of
+        # each length doesn't stall on it
+        for length in self._bucket_lengths():
+            self._forward(self._sample_batch((self.batch_size, length)))
+
+    def _sample_batch(self, shape):
+        # Random tokens in rows of staggered lengths, so warmup and capture take
+        # the same padded-attention path as real batches
+        rows, length = shape
+        lengths = torch.linspace(1, length, rows, device=self.device).long()
+        attention_mask = (torch.arange(length, device=self.device) < lengths.unsqueeze(1)).long()
+        input_ids = torch.randint(0, self.tokenizer.vocab_size, shape, device=self.device)
+        input_ids = input_ids.masked_fill(attention_mask == 0, self.tokenizer.pad_token_id)
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def _forward_torch(self, batch):
+        hidden = self.model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]).last_hidden_state
+        return mean_pool(hidden.float(), batch["attention_mask"])
+
+    def _capture(self, shape):
+        static_batch = self._sample_batch(shape)
+
+        # A few eager forwards on a side stream before capture, as CUDA graphs require
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for _ in range(3):
+                self._forward_torch(static_batch)
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self._graph_pool):
+            output = self._forward_torch(static_batch)
+
+        # Replay on a fresh padded batch and compare with eager, so a graph that
+        # froze a mask-dependent branch fails here instead of skewing results
+        sample = self._sample_batch(shape)
+        static_batch["input_ids"].copy_(sample["input_ids"])
+        static_batch["attention_mask"].copy_(sample["attention_mask"])
+        graph.replay()
+        if not torch.allclose(output, self._forward_torch(sample), rtol=1e-2, atol=1e-2):
+            raise RuntimeError(f"CUDA graph for shape {shape} does not match the eager forward")
+
+        self._graphs[shape] = (static_batch, output, graph)
+        return self._graphs[shape]
+
+    def _forward_graph(self, batch):
+        shape = tuple(batch["input_ids"].shape)
+        static_batch, output, graph = self._graphs.get(shape) or self._capture(shape)
+        static_batch["input_ids"].copy_(batch["input_ids"])
+        static_batch["attention_mask"].copy_(batch["attention_mask"])
+        graph.replay()
+        # The next replay of any graph in the pool overwrites this buffer
+        return output.clone()
+
+    def _forward_onnx(self, batch):
+        input_ids = batch["input_ids"].contiguous()
+        attention_mask = batch["attention_mask"].contiguous()
+        output = self._onnx_output[:input_ids.shape[0]]
+
+        binding = self.session.io_binding()
+        for name, tensor in (("input_ids", input_ids), ("attention_mask", attention_mask)):
+            binding.bind_input(name, "cuda", self.device_id, np.int64, tuple(tensor.shape), tensor.data_ptr())
+        binding.bind_output("embedding", "cuda", self.device_id, np.float32, tuple(output.shape), output.data_ptr())
+
+        # onnxruntime runs on its own stream, so the inputs must be on device first
+        torch.cuda.current_stream().synchronize()
+        self.session.run_with_iobinding(binding)
+        return output.clone()
+
+    def _tokenize(self, texts):
+        if self._tokenizer_pool is None:
+            return tokenize_to_arrays(self.tokenizer, texts, self.max_length)
+
+        chunk = max(TOKENIZE_CHUNK, -(-len(texts) // self.tokenizer_workers))
+        chunks = [texts[start:start + chunk] for start in range(0, len(texts), chunk)]
+        sequences = []
+        for chunk_sequences in self._tokenizer_pool.map(_tokenize_in_worker, chunks, [self.max_length] * len(chunks)):
+            sequences.extend(chunk_sequences)
+        return sequences
+
+    def _pad(self, sequences):
+        # Pad only up to the longest sequence in this batch. When shapes must be
+        # static, round that up to a bucket and add fully masked filler rows,
+        # which are dropped after the forward.
+        length = max(len(sequence) for sequence in sequences)
+        rows = len(sequences)
+        if self.static_shapes:
+            length = -(-length // SEQ_BUCKET) * SEQ_BUCKET
+            rows = self.batch_size
+
+        input_ids = np.full((rows, length), self.tokenizer.pad_token_id, dtype=np.int32)
+        attention_mask = np.zeros((rows, length), dtype=np.int32)
+        for row, sequence in enumerate(sequences):
+            input_ids[row, :len(sequence)] = sequence
+            attention_mask[row, :len(sequence)] = 1
+        return {"input_ids": torch.from_numpy(input_ids), "attention_mask": torch.from_numpy(attention_mask)}
+
+    def _prefetch(self, tensors):
+        # Token ids cross PCIe as int32 and are widened on the device
+        if self.copy_stream is None:
+            return {name: tensor.to(self.device).long() for name, tensor in tensors.items()}
+
+        with torch.cuda.stream(self.copy_stream):
+            return {name: tensor.pin_memory().to(self.device, non_blocking=True).long() for name, tensor in tensors.items()}
+
+    def _wait_for(self, batch):
+        if self.copy_stream is None:
+            return
+        compute_stream = torch.cuda.current_stream()
+        compute_stream.wait_stream(self.copy_stream)
+        # The tensors were allocated on the copy stream; keep the allocator from
+        # reusing them until the compute stream is done with them
+        for tensor in batch.values():
+            tensor.record_stream(compute_stream)
+
+    def prepare(self, texts):
+        # Hashes texts, looks them up in the cache and tokenizes the misses.
+        # Call it off gpu_thread, ahead of submit(), so tokenizing the next
+        # launch overlaps the forwards of the current one.
+        keys = [xxhash.xxh3_64_intdigest(text.encode()) for text in texts]
+        vectors = np.empty((len(texts), self.hidden_size), dtype=np.float32)
+
+        # Texts that are neither cached nor already pending, keyed by hash, with
+        # every position that needs them
+        pending = {}
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    vectors[i] = cached
+                else:
+                    pending.setdefault(key, []).append(i)
+
+        sequences = self._tokenize([texts[positions[0]] for positions in pending.values()]) if pending else []
+        return vectors, pending, sequences
+
+    def submit(self, prepared):
+        # Queues the GPU work for the output of prepare() and returns without
+        # waiting for it; pass the result to collect() (possibly from another
+        # thread). Must be called on gpu_thread.
+        vectors, pending, sequences = prepared
+        launched = self._launch(sequences) if sequences else None
+        return vectors, pending, launched
+
+    def collect(self, job):
+        vectors, pending, launched = job
+        if launched is None:
+            return vectors
+
+        order, host_output, done = launched
+        if done is not None:
+            done.synchronize()
+        computed = np.empty((len(order), self.hidden_size), dtype=np.float32)
+        computed[order] = host_output.numpy()
+
+        for positions, vector in zip(pending.values(), computed):
+            vectors[positions] = vector
+
+        if self.cache_size > 0:
+            # Copy so the cache doesn't pin the whole batch output in memory
+            copies = [vector.copy() for vector in computed]
+            with self._cache_lock:
+                for key, vector in zip(pending, copies):
+                    self._cache[key] = vector
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+        return vectors
+
+    @torch.inference_mode()
+    def _launch(self, sequences):
+        # Batch neighbours in token-length order so short headings are never
+        # padded out to a 512-token abstract
+        order = np.argsort([len(sequence) for sequence in sequences], kind="stable")
+        batch_rows = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+        # A producer thread pads batches ahead of the loop below, which only
+        # moves them to the device and launches the forwards
+        padded = queue.Queue(maxsize=4)
+        stop = threading.Event()
+
+        def put(item):
+            # Give up once the loop below has stopped consuming, so a failed
+            # forward doesn't leave this thread blocked on a full queue
+            while not stop.is_set():
+                try:
+                    padded.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for rows in batch_rows:
+                    if not put(self._pad([sequences[i] for i in rows])):
+                        return
+            except BaseException as error:
+                put(error)
+
+        def next_batch():
+            item = padded.get()
+            if isinstance(item, BaseException):
+                raise item
+            return self._prefetch(item)
+
+        threading.Thread(target=produce, daemon=True).start()
+
+        outputs = []
+        try:
+            batch = next_batch()
+            for i, rows in enumerate(batch_rows):
+                self._wait_for(batch)
+                outputs.append(self._forward(batch)[:len(rows)])
+                # Copy batch N+1 while the forward for batch N runs
+                if i + 1 < len(batch_rows):
+                    batch = next_batch()
+        finally:
+            stop.set()
+
+        output = torch.cat(outputs)
+        if self.device != "cuda":
+            return order, output, None
+
+        # Start the device-to-host copy without waiting on it; collect() blocks
+        # on the event instead
+        host_output = torch.empty(output.shape, dtype=output.dtype, pin_memory=True)
+        host_output.copy_(output, non_blocking=True)
+        done = torch.cuda.Event()
+        done.record()
+        return order, host_output, done
@@ -1,65 +1,102 @@
 import os
-import orjson
-from tqdm import tqdm
+import asyncio
 import argparse
-from langchain_core.documents import Document
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from embedder import Embedder
+from pipeline import embed_files
 import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
 import torch
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# uvloop is a faster drop-in event loop; asyncio's own works too
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 parser = argparse.ArgumentParser(description="Generate embeddings for scientific papers")
 parser.add_argument("--data_path", type=str, required=False, help="Path to the cleaned data directory", default="../../cleaned")
 # parser.add_argument("--output_path", type=str, required=True, help="Path to save Parquet files")
 parser.add_argument("--model_name", type=str, default="allenai/scibert_scivocab_uncased", help="Name of the HuggingFace model to use")
-parser.add_argument("--batch_size", type=int, default=1, help="Batch size for embedding generation")
-parser.add_argument("--num_processes", type=int, default=1, help="Number of processes to use")
+parser.add_argument("--batch_size", type=int, default=64, help="Batch size for embedding generation")
+parser.add_argument("--onnx_path", type=str, default=None, help="Run inference with onnxruntime on this exported model (see export_model.py)")
+parser.add_argument("--cache_size", type=int, default=20000, help="Number of recent text embeddings to cache (0 disables the cache)")
+parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile (slow start-up, faster steady state)")
+parser.add_argument("--cuda_graphs", action="store_true", help="Replay captured CUDA graphs for each batch shape (cannot be combined with --compile)")
+parser.add_argument("--tokenizer_workers", type=int, default=len(os.sched_getaffinity(0)), help="Number of processes used for tokenization (0 tokenizes in-process); defaults to the CPUs this job may run on")
 args = parser.parse_args()
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-embeddings = HuggingFaceEmbeddings(model_name=args.model_name, model_kwargs={'device': device}, encode_kwargs={'normalize_embeddings': False})
-
-def process_document(doc):
-    paper_id = doc['paper_id']
-    abstract_embed = embeddings.embed_query(doc.get('cleaned_abstract', '').lower())
-
-    body_embeds = []
-    for section in doc.get('cleaned_body', []):
-        body_embeds.append(embeddings.embed_query(section['text'].lower()))
-
-    return {
-        'paper_id': paper_id,
-        'abstract_embedding': abstract_embed,
-        'body_embeddings': body_embeds,
-        # 'original_json': orjson.dumps(doc).decode()  # Store original JSON as string
-    }
-
-def process_file(file_path):
-    with open(file_path, 'r') as f:
-        documents = [orjson.loads(line) for line in f]
-
-    processed_docs = []
-    for doc in tqdm(documents, desc=f"Processing {os.path.basename(file_path)}"):
-        processed_docs.append(process_document(doc))
-
-    return processed_docs
-
-def save_to_parquet(data, output_file):
-    table = pa.Table.from_pylist(data)
-    pq.write_table(table, output_file)
-
-def main():
-    for year in os.listdir(args.data_path):
-        year_path = os.path.join(args.data_path, year)
-        if not os.path.isdir(year_path):
+embedder = Embedder(args.model_name, device=device, batch_size=args.batch_size, onnx_path=args.onnx_path, cache_size=args.cache_size, compile_model=args.compile, cuda_graphs=args.cuda_graphs, tokenizer_workers=args.tokenizer_workers)
+
+ROWS_PER_GROUP = 10_000
+
+def make_schema(embed_dim):
+    # Explicit schema so pyarrow never has to infer types
+    return pa.schema([
+        ('paper_id', pa.string()),
+        ('abstract_embedding', pa.list_(pa.float16(), embed_dim)),
+        ('body_embeddings', pa.list_(pa.list_(pa.float16(), embed_dim))),
+    ])
+
+def write_row_group(writer, docs):
+    # Build the columns straight from the fp16 arrays instead of via Python lists
+    embed_dim = writer.schema.field('abstract_embedding').type.list_size
+    paper_ids = pa.array([doc['paper_id'] for doc in docs], type=pa.string())
+    abstracts = np.stack([doc['abstract_embedding'] for doc in docs])
+    bodies = np.concatenate([doc['body_embeddings'] for doc in docs])
+    offsets = np.zeros(len(docs) + 1, dtype=np.int32)
+    np.cumsum([len(doc['body_embeddings']) for doc in docs], out=offsets[1:])
+
+    batch = pa.RecordBatch.from_arrays([
+        paper_ids,
+        pa.FixedSizeListArray.from_arrays(abstracts.ravel(), embed_dim),
+        pa.ListArray.from_arrays(offsets, pa.FixedSizeListArray.from_arrays(bodies.ravel(), embed_dim)),
+    ], schema=writer.schema)
+    writer.write_batch(batch)
+
+def document_rows(documents, starts, vectors):
+    return [
+        {
+            'paper_id': doc['paper_id'],
+            'abstract_embedding': vectors[start],
+            'body_embeddings': vectors[start + 1:end],
+        }
+        for doc, start, end in zip(documents, starts, starts[1:])
+    ]
+
+async def embed_field(files, output_file, schema):
+    # Stream row groups out as batches finish so memory stays bounded; write to
+    # a temporary name so a crash never leaves a file that looks finished
+    tmp_file = output_file + ".tmp"
+    pending = []
+    with pq.ParquetWriter(tmp_file, schema, compression="zstd", compression_level=3, use_dictionary=True) as writer:
+        def handle_batch(documents, starts, vectors):
+            pending.extend(document_rows(documents, starts, vectors))
+            while len(pending) >= ROWS_PER_GROUP:
+                write_row_group(writer, pending[:ROWS_PER_GROUP])
+                del pending[:ROWS_PER_GROUP]
+
+        await embed_files(embedder, files, handle_batch)
+        if pending:
+            write_row_group(writer, pending)
+    os.replace(tmp_file, output_file)
+
+async def main():
+    schema = make_schema(embedder.hidden_size)
+
+    # scandir entries carry the file type from the directory read, so no
+    # per-entry stat is needed
+    for year_entry in os.scandir(args.data_path):
+        if not year_entry.is_dir():
             continue
+        year = year_entry.name
 
-        for field in os.listdir(year_path):
-            field_path = os.path.join(year_path, field)
-            if not os.path.isdir(field_path):
+        for field_entry in os.scandir(year_entry.path):
+            if not field_entry.is_dir():
                 continue
+            field = field_entry.name
+            field_path = field_entry.path
             print(f"Processing year {year}, field {field}")
             # save in the same directory as the cleaned data
             output_file = os.path.join(field_path, f"{year}_{field}.parquet")
@@ -68,15 +105,10 @@ def main():
                 print(f"Skipping {year}_{field}, Parquet file already exists.")
                 continue
 
-            files = [os.path.join(field_path, f) for f in os.listdir(field_path) if f.endswith('.jsonl')]
-
-            all_processed_docs = []
-            with ProcessPoolExecutor(max_workers=args.num_processes) as executor:
-                for processed_docs in executor.map(process_file, files):
-                    all_processed_docs.extend(processed_docs)
+            files = [entry.path for entry in os.scandir(field_path) if entry.name.endswith('.jsonl')]
 
-            save_to_parquet(all_processed_docs, output_file)
+            await embed_field(files, output_file, schema)
             print(f"Saved {output_file}")
 
 if __name__ == "__main__":
-    main()
+    (uvloop.run if uvloop is not None else asyncio.run)(main())
@@ -1,54 +1,73 @@
 import os
-import orjson
+import asyncio
 import numpy as np
-from tqdm import tqdm
 import argparse
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import pyarrow as pa
+import pyarrow.parquet as pq
+from embedder import Embedder
+from pipeline import embed_files
+
+# uvloop is a faster drop-in event loop; asyncio's own works too
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 parser = argparse.ArgumentParser(description="Generate embeddings for scientific papers")
 parser.add_argument("--data_path", type=str, required=False, help="Path to the cleaned data directory", default="../../cleaned")
 parser.add_argument("--model_name", type=str, default="allenai/scibert_scivocab_uncased", help="Name of the HuggingFace model to use")
+parser.add_argument("--batch_size", type=int, default=64, help="Batch size for embedding generation")
+parser.add_argument("--onnx_path", type=str, default=None, help="Run inference with onnxruntime on this exported model (see export_model.py)")
+parser.add_argument("--cache_size", type=int, default=20000, help="Number of recent text embeddings to cache (0 disables the cache)")
+parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile (slow start-up, faster steady state)")
+parser.add_argument("--cuda_graphs", action="store_true", help="Replay captured CUDA graphs for each batch shape (cannot be combined with --compile)")
+parser.add_argument("--tokenizer_workers", type=int, default=len(os.sched_getaffinity(0)), help="Number of processes used for tokenization (0 tokenizes in-process); defaults to the CPUs this job may run on")
 
 args = parser.parse_args()
 
 device = "cuda"
-embeddings = HuggingFaceEmbeddings(model_name=args.model_name, model_kwargs={'device': device}, encode_kwargs={'normalize_embeddings': False})
-
-def process_document(doc):
-    paper_id = doc['paper_id']
-    abstract_embed = embeddings.embed_query(doc.get('cleaned_abstract', '').lower())
-    body_embeds = []
-    for section in doc.get('cleaned_body', []):
-        body_embeds.append(embeddings.embed_query(section['text'].lower()))
-    return {
-        'paper_id': paper_id,
-        'abstract_embedding': abstract_embed,
-        'body_embeddings': body_embeds,
-    }
-
-def process_file(file_path, output_dir):
-    with open(file_path, 'r') as f:
-        documents = [orjson.loads(line) for line in f]
-
-    for doc in tqdm(documents, desc=f"Processing {os.path.basename(file_path)}"):
-        processed_doc = process_document(doc)
-        save_as_npy(processed_doc, output_dir)
-
-def save_as_npy(data, output_dir):
-    paper_id = data['paper_id']
-    output_file = os.path.join(output_dir, f"{paper_id}.npy")
-    np.save(output_file, data)
-
-def main():
-    for year in os.listdir(args.data_path):
-        year_path = os.path.join(args.data_path, year)
-        if not os.path.isdir(year_path):
+embedder = Embedder(args.model_name, device=device, batch_size=args.batch_size, onnx_path=args.onnx_path, cache_size=args.cache_size, compile_model=args.compile, cuda_graphs=args.cuda_graphs, tokenizer_workers=args.tokenizer_workers)
+
+def save_index(paper_ids, row_counts, embed_dim, output_file):
+    offsets = np.zeros(len(row_counts), dtype=np.int64)
+    np.cumsum(row_counts[:-1], out=offsets[1:])
+    table = pa.table(
+        {'paper_id': paper_ids, 'offset': offsets, 'num_rows': row_counts.astype(np.int32)},
+        metadata={'embed_dim': str(embed_dim), 'dtype': 'float16'},
+    )
+    pq.write_table(table, output_file)
+
+async def embed_field(files, output_dir):
+    # All of a field's embeddings go into one raw float16 shard, read back with
+    # np.memmap(..., dtype=np.float16).reshape(-1, embed_dim). Each paper owns
+    # num_rows rows starting at offset: its abstract first, then its sections
+    # in order.
+    paper_ids = []
+    row_counts = []
+    with open(os.path.join(output_dir, 'embeds.f16.mmap'), 'wb') as shard:
+        def handle_batch(documents, starts, vectors):
+            shard.write(vectors.tobytes())
+            paper_ids.extend(doc['paper_id'] for doc in documents)
+            row_counts.append(np.diff(starts))
+
+        await embed_files(embedder, files, handle_batch)
+
+    row_counts = np.concatenate(row_counts) if row_counts else np.zeros(0, dtype=np.int64)
+    save_index(paper_ids, row_counts, embedder.hidden_size, os.path.join(output_dir, 'paper_ids.parquet'))
+
+async def main():
+    # scandir entries carry the file type from the directory read, so no
+    # per-entry stat is needed
+    for year_entry in os.scandir(args.data_path):
+        if not year_entry.is_dir():
             continue
+        year = year_entry.name
 
-        for field in os.listdir(year_path):
-            field_path = os.path.join(year_path, field)
-            if not os.path.isdir(field_path):
+        for field_entry in os.scandir(year_entry.path):
+            if not field_entry.is_dir():
                 continue
+            field = field_entry.name
+            field_path = field_entry.path
 
             print(f"Processing year {year}, field {field}")
 
@@ -56,12 +75,11 @@ def main():
             output_dir = os.path.join(field_path, 'embeddings')
             os.makedirs(output_dir, exist_ok=True)
 
-            files = [os.path.join(field_path, f) for f in os.listdir(field_path) if f.endswith('.jsonl')]
+            files = [entry.path for entry in os.scandir(field_path) if entry.name.endswith('.jsonl')]
 
-            for file in files:
-                process_file(file, output_dir)
+            await embed_field(files, output_dir)
 
             print(f"Finished processing {year}_{field}")
 
 if __name__ == "__main__":
-    main()
+    (uvloop.run if uvloop is not None else asyncio.run)(main())
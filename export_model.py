@@ -0,0 +1,52 @@
+import argparse
+import torch
+from transformers import AutoModel, AutoTokenizer
+from embedder import mean_pool
+
+parser = argparse.ArgumentParser(description="Export the embedding model to ONNX for Embedder(onnx_path=...)")
+parser.add_argument("--model_name", type=str, default="allenai/scibert_scivocab_uncased", help="Name of the HuggingFace model to use")
+parser.add_argument("--onnx_path", type=str, default="scibert.onnx", help="Where to write the ONNX model")
+parser.add_argument("--opset", type=int, default=17, help="ONNX opset version")
+
+class PooledModel(torch.nn.Module):
+    # Export the mean-pooled embedding rather than the full hidden state so
+    # only (batch, hidden) floats ever leave the GPU
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        hidden = self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+        return mean_pool(hidden.float(), attention_mask)
+
+def export_onnx(model_name, onnx_path, opset):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    model = AutoModel.from_pretrained(model_name, torch_dtype=torch.float16).to("cuda").eval()
+
+    sample = tokenizer(["a sample sentence for tracing"], return_tensors="pt").to("cuda")
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "sequence"},
+        "embedding": {0: "batch"},
+    }
+    # The TorchScript tracer, which dynamic_axes is written for, needs version
+    # counters for BERT's in-place ops, so this can't run under inference_mode
+    with torch.no_grad():
+        torch.onnx.export(
+            PooledModel(model),
+            (sample["input_ids"], sample["attention_mask"]),
+            onnx_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["embedding"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            dynamo=False,
+        )
+    print(f"Saved {onnx_path}")
+
+def main():
+    args = parser.parse_args()
+    export_onnx(args.model_name, args.onnx_path, args.opset)
+
+if __name__ == "__main__":
+    main()
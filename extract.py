@@ -1,51 +1,63 @@
-import json
 import os
 import multiprocessing
-import itertools
-from typing import Dict, List, Tuple, Iterator
+from typing import Dict, List, Tuple
 from functools import partial
 from tqdm import tqdm
 import psutil
+import orjson
+import ahocorasick
+from build_index import ensure_index, field_offsets, index_path
 
-def load_jsonl(file_path: str) -> Iterator[Dict]:
-    with open(file_path, 'r') as file:
-        for line in file:
-            yield json.loads(line)
-
-def clean_text(text: str, formula_dict: Dict, citation_dict: Dict) -> Tuple[str, Dict, Dict]:
-    formula_counter = 1
-    citation_counter = 1
+def build_replacer(formula_keys: List[str], formula_values: List, citation_keys: List[str], citation_values: List) -> Tuple[ahocorasick.Automaton, Dict, Dict]:
     formula_lookup = {}
     citation_lookup = {}
+    automaton = ahocorasick.Automaton()
 
-    for formula_id, formula in formula_dict.items():
+    for formula_counter, (marker, formula) in enumerate(zip(formula_keys, formula_values), start=1):
         placeholder = f"[FORMULA_{formula_counter}]"
-        text = text.replace(f"{{{{formula:{formula_id}}}}}", placeholder)
+        automaton.add_word(marker, (len(marker), placeholder))
         formula_lookup[placeholder] = formula
-        formula_counter += 1
 
-    for citation_id, citation in citation_dict.items():
+    for citation_counter, (marker, citation) in enumerate(zip(citation_keys, citation_values), start=1):
         placeholder = f"[CITATION_{citation_counter}]"
-        text = text.replace(f"{{{{cite:{citation_id}}}}}", placeholder)
+        automaton.add_word(marker, (len(marker), placeholder))
         citation_lookup[placeholder] = citation
-        citation_counter += 1
 
-    return text, formula_lookup, citation_lookup
+    automaton.make_automaton()
+    return automaton, formula_lookup, citation_lookup
+
+def apply_replacer(replacer: Tuple[ahocorasick.Automaton, Dict, Dict], text: str) -> str:
+    automaton = replacer[0]
+    if len(automaton) == 0:
+        return text
+
+    # Single linear scan over the text no matter how many markers there are
+    pieces = []
+    last = 0
+    for end, (length, placeholder) in automaton.iter(text):
+        start = end - length + 1
+        if start < last:
+            continue
+        pieces.append(text[last:start])
+        pieces.append(placeholder)
+        last = end + 1
+    pieces.append(text[last:])
+
+    return ''.join(pieces)
 
 def process_paper(paper: Dict) -> Dict:
-    cleaned_abstract, abstract_formula_lookup, abstract_citation_lookup = clean_text(
-        paper['abstract']['text'],
-        paper['ref_entries'],
-        paper['bib_entries']
-    )
+    # ref_entries/bib_entries are shared by the abstract and every section, so
+    # the marker strings and the replacer are built once per paper
+    ref_entries = paper['ref_entries']
+    bib_entries = paper['bib_entries']
+    formula_keys = [f"{{{{formula:{formula_id}}}}}" for formula_id in ref_entries]
+    citation_keys = [f"{{{{cite:{citation_id}}}}}" for citation_id in bib_entries]
+    replacer = build_replacer(formula_keys, list(ref_entries.values()), citation_keys, list(bib_entries.values()))
+    cleaned_abstract = apply_replacer(replacer, paper['abstract']['text'])
 
     cleaned_body = []
     for section in paper['body_text']:
-        cleaned_section, section_formula_lookup, section_citation_lookup = clean_text(
-            section['text'],
-            paper['ref_entries'],
-            paper['bib_entries']
-        )
+        cleaned_section = apply_replacer(replacer, section['text'])
         cleaned_body.append({
             'section': section['section'],
             'sec_number': section['sec_number'],
@@ -63,15 +75,6 @@ def process_paper(paper: Dict) -> Dict:
 def process_chunk(papers: List[Dict]) -> List[Dict]:
     return [process_paper(paper) for paper in papers]
 
-def chunked_parallel_process(papers_iterator: Iterator[Dict], chunk_size: int, num_processes: int) -> Iterator[Dict]:
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        while True:
-            chunk = list(itertools.islice(papers_iterator, chunk_size))
-            if not chunk:
-                break
-            for result in pool.imap(process_paper, chunk):
-                yield result
-
 def process_year_field(year: int, field: str, source_dir: str, output_dir: str, num_processes: int, chunk_size: int, max_memory_percent: float):
     year_dir = os.path.join(source_dir, str(year))
     output_year_dir = os.path.join(output_dir, str(year), field)
@@ -79,24 +82,26 @@ def process_year_field(year: int, field: str, source_dir: str, output_dir: str,
 
     output_file = os.path.join(output_year_dir, f"cleaned_{field}_{year}.jsonl")
 
-    def paper_generator():
-        for file_name in os.listdir(year_dir):
-            if file_name.endswith('.jsonl'):
-                file_path = os.path.join(year_dir, file_name)
-                for paper in load_jsonl(file_path):
-                    if paper['discipline'] == field:
-                        yield paper
-
-    total_papers = sum(1 for _ in paper_generator())
+    # The index is built once per year, so each field only reads its own papers
+    index_file = index_path(output_dir, year)
+    ensure_index(year_dir, index_file)
+    offsets = field_offsets(index_file, field)
 
-    with open(output_file, 'w') as out_file:
+    def paper_generator():
+        for file_name, file_offsets in offsets.items():
+            with open(os.path.join(year_dir, file_name), 'rb') as file:
+                for offset in file_offsets:
+                    file.seek(offset)
+                    yield orjson.loads(file.readline())
+
+    # Output order doesn't matter, so let workers hand back results as soon as
+    # they finish; the bar has no total to avoid a second pass over the input
+    with multiprocessing.Pool(processes=num_processes) as pool, open(output_file, 'wb') as out_file:
         for processed_paper in tqdm(
-            chunked_parallel_process(paper_generator(), chunk_size, num_processes),
-            total=total_papers,
+            pool.imap_unordered(process_paper, paper_generator(), chunksize=chunk_size),
             desc=f"Processing {field} papers for {year}"
         ):
-            json.dump(processed_paper, out_file)
-            out_file.write('\n')
+            out_file.write(orjson.dumps(processed_paper) + b"\n")
 
             # Check memory usage and adjust if necessary
             if psutil.virtual_memory().percent > max_memory_percent:
@@ -136,7 +141,7 @@ if __name__ == "__main__":
 
     # fields_to_process = ["Computer Science", "Physics", "Mathematics"]
     num_processes = multiprocessing.cpu_count()# // 2  # Use half of available CPU cores
-    chunk_size = 100  # Process 100 papers at a time
+    chunk_size = 64  # Send 64 papers to a worker at a time
     max_memory_percent = 80.0  # Adjust processes if memory usage exceeds 80%
 
     main(source_directory, output_directory, num_processes, chunk_size, max_memory_percent)
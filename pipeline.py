@@ -0,0 +1,90 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import aiofiles
+import numpy as np
+import orjson
+
+DOCS_PER_BATCH = 512
+MAX_IN_FLIGHT = 4
+# Bytes per read; each read is one hop to aiofiles' thread, so keep it large
+READ_BLOCK = 1 << 22
+
+def document_texts(doc):
+    texts = [doc.get('cleaned_abstract', '')] + [section['text'] for section in doc.get('cleaned_body', [])]
+    # Skip the copy for texts that are already lowercase
+    return [text if text.islower() else text.lower() for text in texts]
+
+def flatten_documents(documents):
+    # Each paper's texts are contiguous: its abstract followed by its sections,
+    # so paper i owns rows starts[i]:starts[i + 1] of the output
+    texts = []
+    starts = []
+    for doc in documents:
+        starts.append(len(texts))
+        texts.extend(document_texts(doc))
+    starts.append(len(texts))
+    return texts, starts
+
+async def read_documents(file_paths, queue):
+    try:
+        for file_path in file_paths:
+            documents = []
+            tail = b""
+            async with aiofiles.open(file_path, 'rb') as f:
+                while block := await f.read(READ_BLOCK):
+                    # The last piece may be a partial line; carry it into the
+                    # next block
+                    lines = (tail + block).split(b"\n")
+                    tail = lines.pop()
+                    for line in lines:
+                        if not line:
+                            continue
+                        documents.append(orjson.loads(line))
+                        if len(documents) == DOCS_PER_BATCH:
+                            await queue.put(documents)
+                            documents = []
+            if tail.strip():
+                documents.append(orjson.loads(tail))
+            if documents:
+                await queue.put(documents)
+    finally:
+        await queue.put(None)
+
+async def embed_files(embedder, file_paths, handle_batch):
+    # Reading and parsing happen on the event loop. One thread hashes and
+    # tokenizes each chunk while the embedder's GPU thread launches the forwards
+    # for the chunk before it. A third thread waits for results to reach the
+    # host and calls handle_batch(documents, starts, vectors) with float16
+    # vectors, so the GPU thread never blocks on a device-to-host copy.
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=MAX_IN_FLIGHT)
+    reader = asyncio.create_task(read_documents(file_paths, queue))
+
+    def prepare(documents):
+        texts, starts = flatten_documents(documents)
+        return starts, embedder.prepare(texts)
+
+    def postprocess(documents, starts, job):
+        vectors = embedder.collect(job).astype(np.float16)
+        handle_batch(documents, starts, vectors)
+
+    with ThreadPoolExecutor(max_workers=1) as prepare_thread, ThreadPoolExecutor(max_workers=1) as postprocess_thread:
+        in_flight = []
+
+        async def launch(documents, preparing):
+            starts, prepared = await preparing
+            job = await loop.run_in_executor(embedder.gpu_thread, embedder.submit, prepared)
+            in_flight.append(loop.run_in_executor(postprocess_thread, postprocess, documents, starts, job))
+            if len(in_flight) > MAX_IN_FLIGHT:
+                await in_flight.pop(0)
+
+        preparing = []
+        while (documents := await queue.get()) is not None:
+            preparing.append((documents, loop.run_in_executor(prepare_thread, prepare, documents)))
+            # Launch the chunk before this one while this one is tokenized
+            if len(preparing) > 1:
+                await launch(*preparing.pop(0))
+        for documents, prepared in preparing:
+            await launch(documents, prepared)
+        await asyncio.gather(*in_flight)
+        await reader